@@ -1,9 +1,13 @@
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import functools
+import itertools
 import traceback
 
 try:
-    from database import MyDB, Collection
+    from database import MyDB, Collection, split_fields, validate_schema
+    from queryParser import split_ops
 except ImportError as e:
     st.error(f"Failed to import database module: {e}")
     st.write("Ensure all required files (__init__.py, mydb_types.py, query.py, queryParser.py, index.py, transaction.py, database.py) are in the same directory as app.py.")
@@ -12,10 +16,16 @@ except ImportError as e:
 # Set page title
 st.title("MyDB: Simple Database with Streamlit")
 
+# One database per process: every session shares it, since each MyDB replays and
+# appends to the same WAL and rewrites the same collection files
+@st.cache_resource
+def get_db():
+    return MyDB()
+
 # Initialize Database in Session State
 if 'db' not in st.session_state:
     try:
-        st.session_state.db = MyDB()
+        st.session_state.db = get_db()
         st.success("Database initialized successfully")
     except Exception as e:
         st.error(f"Failed to initialize database: {e}")
@@ -23,21 +33,77 @@ if 'db' not in st.session_state:
 
 db = st.session_state.db
 
-# Cache collection data
-@st.cache_data
-def get_collection_data(collection_name):
-    collection = db.collections.get(collection_name)
-    if collection and collection.data:
-        return pd.DataFrame(list(collection.data.values()))
-    return None
-
-# Cache query results
-@st.cache_data
-def run_query(collection_name, query_str):
-    collection = db.collections.get(collection_name)
-    if collection:
-        return collection.parse_query(query_str)
-    return []
+# Helpers take the database as _db instead of closing over the script globals,
+# which are rebuilt on every rerun while cached helpers outlive them
+def get_collection_names(_db=db):
+    # Collections are only ever added, and other sessions may add them too, so the
+    # count tells whether the cached name tuple is stale
+    count, names = st.session_state.get('_collection_names', (-1, ()))
+    if count != len(_db.collections):
+        names = tuple(_db.collections.keys())
+        st.session_state._collection_names = (len(names), names)
+    return names
+
+def get_collection_data(collection_name, _db=db):
+    collection = _db.collections.get(collection_name)
+    if not collection or not collection.data:
+        return None
+    return pd.DataFrame(collection.columns(), copy=False)
+
+# Queries starting with these keywords mutate the collection and are never cached
+_WRITE_ACTIONS = frozenset(("ADD", "MODIFY", "REMOVE", "TRANSACT", "INDEX"))
+
+def run_read_query(collection_name, versions, query_str, _db):
+    return _db.collections[collection_name].parse_query(query_str)
+
+# Read results are keyed on the collection version, so any write invalidates them
+if '_read_query_cache' not in st.session_state:
+    st.session_state._read_query_cache = functools.lru_cache(maxsize=256)(run_read_query)
+
+def run_write_query(collection_name, query_str, _db=db):
+    return _db.collections[collection_name].parse_query(query_str)
+
+def show_error(message):
+    st.error(message)
+    # Tracebacks are only formatted when asked for from the sidebar
+    if st.session_state.get('debug'):
+        st.code(traceback.format_exc())
+
+def to_table(results):
+    try:
+        return pa.Table.from_pylist(results)
+    except pa.ArrowException:
+        # A column mixing value types cannot be typed by Arrow, pandas keeps it as objects
+        return pd.DataFrame(results)
+
+# Only one page of a result set is sent to the browser at a time
+RESULTS_PAGE_SIZE = 1000
+
+def table_page(table, page):
+    start = (page - 1) * RESULTS_PAGE_SIZE
+    if isinstance(table, pa.Table):
+        return table.slice(start, RESULTS_PAGE_SIZE)
+    return table.iloc[start:start + RESULTS_PAGE_SIZE]
+
+def run_query_batch(collection_name, ops, _db=db):
+    return _db.collections[collection_name].parse_query_batch(ops)
+
+def run_query(collection_name, query_str, _db=db):
+    collection = _db.collections.get(collection_name)
+    if not collection:
+        return {"results": [], "execution_time": 0.0}
+    action = (query_str.split(None, 1) or [""])[0].upper()
+    if action in _WRITE_ACTIONS:
+        return run_write_query(collection_name, query_str, _db)
+    # The versions are the invalidation key; _db is hashed by identity, never pickled.
+    # A join also reads the other collection, named right after the keyword
+    versions = (collection.version,)
+    if action == "JOIN":
+        words = query_str.split(None, 2)
+        other = _db.collections.get(words[1]) if len(words) > 1 else None
+        if other is not None:
+            versions += (other.version,)
+    return st.session_state._read_query_cache(collection_name, versions, query_str, _db)
 
 # Sidebar for Collection Management
 st.sidebar.header("Collection Management")
@@ -48,14 +114,14 @@ if st.sidebar.button("Create Collection"):
         st.sidebar.error("Collection name is required")
     else:
         try:
-            schema = [s.strip() for s in schema_input.split(",")] if schema_input else []
+            schema = validate_schema(schema_input) if schema_input else []
             result = db.create_collection(collection_name, schema)
             st.sidebar.success(result)
         except Exception as e:
             st.sidebar.error(f"Failed to create collection: {e}")
 
 # Select Collection
-collection_names = list(db.collections.keys())
+collection_names = get_collection_names()
 if not collection_names:
     st.write("No collections available. Create a collection to start.")
     selected_collection = None
@@ -73,12 +139,13 @@ if st.sidebar.button("Create Index"):
         st.sidebar.error("Index fields are required")
     else:
         try:
-            fields = [f.strip() for f in index_fields.split(",")]
+            fields = split_fields(index_fields)
             query = f"INDEX FIELD {','.join(fields)}"
-            results = run_query(selected_collection, query)
+            run_query(selected_collection, query)
             st.sidebar.success(f"Index created on {','.join(fields)}")
         except Exception as e:
             st.sidebar.error(f"Failed to create index: {e}")
+st.sidebar.checkbox("Show error tracebacks", key="debug")
 
 # Main Interface
 if collection:
@@ -98,21 +165,30 @@ if collection:
     )
     query = st.text_input("Enter Query", placeholder=query_examples)
     if st.button("Run Query"):
+        st.session_state.query_results = None
         if not query:
             st.error("Query cannot be empty")
         else:
             try:
-                results = run_query(selected_collection, query)
-                if isinstance(results, dict) and "execution_time" in results:
-                    execution_time = results.pop("execution_time")
-                    st.write(f"Query execution time: {execution_time:.3f} seconds")
-                if results:
-                    st.write("Query Results:")
-                    st.dataframe(pd.DataFrame(results))
-                else:
-                    st.warning("No results returned")
+                response = run_query(selected_collection, query)
+                # Kept across reruns so paging through the results does not rerun the query
+                st.session_state.query_results = (selected_collection, response["execution_time"], to_table(response["results"]))
+                st.session_state.results_page = 1
             except Exception as e:
-                st.error(f"Query failed: {e}\n{traceback.format_exc()}")
+                show_error(f"Query failed: {e}")
+    query_results = st.session_state.get('query_results')
+    if query_results and query_results[0] == selected_collection:
+        _, execution_time, table = query_results
+        st.write(f"Query execution time: {execution_time:.3f} seconds")
+        if len(table):
+            st.write("Query Results:")
+            pages = (len(table) - 1) // RESULTS_PAGE_SIZE + 1
+            page = 1
+            if pages > 1:
+                page = st.number_input(f"Page (of {pages})", min_value=1, max_value=pages, key="results_page")
+            st.dataframe(table_page(table, page))
+        else:
+            st.warning("No results returned")
 
     # Transaction Management
     st.subheader("Transaction Manager")
@@ -126,13 +202,11 @@ if collection:
             st.error("Transaction operations cannot be empty")
         else:
             try:
-                results = run_query(selected_collection, f"TRANSACT OPS ({tx_query})")
-                if isinstance(results, dict) and "execution_time" in results:
-                    execution_time = results.pop("execution_time")
-                    st.write(f"Transaction execution time: {execution_time:.3f} seconds")
-                st.success(f"Transaction: {results[0]['transaction']}")
+                response = run_query_batch(selected_collection, split_ops(tx_query))
+                st.write(f"Transaction execution time: {response['execution_time']:.3f} seconds")
+                st.success(f"Transaction: {response['results'][0]['transaction']}")
             except Exception as e:
-                st.error(f"Transaction failed: {e}\n{traceback.format_exc()}")
+                show_error(f"Transaction failed: {e}")
 
     # Display Collection Data
     st.subheader("Collection Data")
@@ -145,8 +219,15 @@ if collection:
     # Display Indexes
     st.subheader("Indexes")
     if collection.indexes:
-        for field, index in collection.indexes.items():
-            st.write(f"Index on {field}: {index}")
+        rows = [
+            {
+                "field": field,
+                "entries": len(index),
+                "sample": repr(dict(itertools.islice(index.items(), 5)))[:80],
+            }
+            for field, index in collection.indexes.items()
+        ]
+        st.dataframe(pd.DataFrame(rows))
     else:
         st.write("No indexes created")
 else:
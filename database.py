@@ -1,98 +1,563 @@
+import atexit
+import functools
+import itertools
 import json
+import operator
 import os
+import re
+import sys
 import time
-from github import Github
-from threading import Lock
-from datetime import datetime, timedelta
-from typing import Dict, List, Tuple
+from collections import OrderedDict
+from github import Github, InputGitTreeElement
+from contextlib import ExitStack, contextmanager
+from threading import Condition, Lock, RLock, Timer
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Set, Tuple
 from mydb_types import Data, Record, Records, Indexes, Conditions
 from index import IndexManager
 from query import Query, QueryAction
-from queryParser import parse_my_query
+from queryParser import parse_my_query, parse_transact_op
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_IDENT_RE = re.compile(r"[a-zA-Z0-9_]{1,50}")
+_SCHEMA_RE = re.compile(r"\s*[a-zA-Z0-9_]{1,50}(?:\s*,\s*[a-zA-Z0-9_]{1,50})*\s*")
+_FIELD_SPLIT = re.compile(r"\s*,\s*")
+_RESERVED = frozenset(("_id", "created_at", "updated_at"))
+# Fields a record may carry whether or not the schema lists them
+_OPTIONAL_FIELDS = frozenset(("ttl", "updated_at"))
+# Aggregates that have no value (rather than 0) when no row had the field
+_NULL_AGGREGATES = frozenset(("$avg", "$min", "$max"))
+# Fields stored as native floats, everything else is stored as a string
+_NUMERIC_FIELDS = frozenset(("age",))
+_RANGE_OPS = frozenset(("$gt", "$gte", "$lt", "$lte"))
+
+# Only reads are cached, repeating a write must run it again
+_CACHED_ACTIONS = frozenset((QueryAction.SELECT, QueryAction.AGGREGATE, QueryAction.JOIN))
+
+# Below this many rows the per-record loop is cheaper than building column arrays
+_VECTOR_MIN_ROWS = 100
+_ARRAY_REDUCERS = {"$avg": "mean", "$sum": "sum", "$min": "min", "$max": "max"}
+
+def _encode_default(obj):
+    # Index buckets are sets in memory and lists on disk
+    if isinstance(obj, set):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+# json.dumps builds a new encoder on every call once default= is passed, these are reused
+_ENCODER = json.JSONEncoder(default=_encode_default, check_circular=False, ensure_ascii=False)
+_INDENT_ENCODER = json.JSONEncoder(default=_encode_default, check_circular=False, ensure_ascii=False, indent=2)
+
+def _dumps(obj, indent: bool = False) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, default=_encode_default, option=orjson.OPT_INDENT_2 if indent else 0)
+    return (_INDENT_ENCODER if indent else _ENCODER).encode(obj).encode()
+
+def _loads(content: bytes):
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+def _fsync_dir(path: str):
+    # Makes the renames inside the directory durable. Windows cannot open a directory
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+@functools.lru_cache(maxsize=1024)
+def _valid_name(name: str) -> bool:
+    return bool(_IDENT_RE.fullmatch(name))
+
+# Apart from the numeric fields, records store values as strings, so the same few
+# distinct values are coerced over and over by scans. Memoize the coercions instead
+# of caching them on the records
+@functools.lru_cache(maxsize=65536)
+def _parse_float(value) -> Optional[float]:
+    try:
+        num = float(str(value).strip())
+    except (ValueError, TypeError):
+        return None
+    return None if num != num else num
+
+def _as_float(value) -> Optional[float]:
+    # Numeric fields are stored as floats, only strings need parsing. NaN counts as
+    # non-numeric, as it does in the column arrays, so the row and vector paths agree
+    if type(value) is float:
+        return None if value != value else value
+    return _parse_float(value)
+
+@functools.lru_cache(maxsize=65536)
+def _timestamp(time_str: str) -> float:
+    return datetime.fromisoformat(time_str).timestamp()
+
+# Repeated query strings, as re-run from the UI, skip the regex parse
+@functools.lru_cache(maxsize=1024)
+def _parse_cached(query_str: str) -> Query:
+    return parse_my_query(query_str)
+
+_RANGE_CHECKS = {"$gt": operator.gt, "$gte": operator.ge, "$lt": operator.lt, "$lte": operator.le}
+
+# Conditions are turned into tests once per query, with literals already converted,
+# so the per-record work is the comparison itself
+def _equals_test(field: str, expected: str) -> Callable[[Record], bool]:
+    def test(record):
+        value = record.get(field)
+        return value is not None and str(value) == expected
+    return test
+
+def _compare_test(field: str, ops: Dict) -> Callable[[Record], bool]:
+    members = None
+    bounds = []
+    for op, value in ops.items():
+        if op == "$in":
+            members = frozenset(str(v) for v in value)
+            continue
+        try:
+            bounds.append((_RANGE_CHECKS.get(op), float(value)))
+        except (ValueError, TypeError):
+            return lambda record: False
+    # Any operator besides $in compares numbers, so the value has to parse as one
+    numeric = bool(bounds)
+    bounds = [(check, bound) for check, bound in bounds if check is not None]
+
+    def test(record):
+        value = record.get(field)
+        if value is None:
+            return False
+        if members is not None and str(value) not in members:
+            return False
+        if numeric:
+            num = _as_float(value)
+            if num is None:
+                return False
+            for check, bound in bounds:
+                if not check(num, bound):
+                    return False
+        return True
+    return test
+
+def _present_test(field: str) -> Callable[[Record], bool]:
+    return lambda record: record.get(field) is not None
+
+def _sort_key(value) -> Tuple[int, object]:
+    # list.sort calls this once per row. Numbers (and digit strings) sort before text,
+    # so a column mixing both no longer fails comparing a float with a str
+    if isinstance(value, (int, float)):
+        return (0, float(value))
+    if str(value).replace(".", "", 1).isdigit():
+        return (0, float(value))
+    return (1, value)
+
+def _typed_sort_key(rows: List[Dict], field: str, fallback: Callable) -> Callable:
+    # Decided once per sort: when every row holds a float the values compare as they are
+    if all(type(row.get(field)) is float for row in rows):
+        return operator.itemgetter(field)
+    return fallback
+
+def _residual_conditions(conditions: Dict, covered: List[str]) -> Dict:
+    # Drop the equality conditions an index lookup has already applied
+    return {field: condition for field, condition in conditions.items()
+            if not (field in covered and isinstance(condition, str))}
+
+def _id_order(key: str) -> Tuple[int, object]:
+    # Ids are handed out counting up, so numeric order is insertion order, the order a
+    # full scan returns. Set order would change with hash randomization between runs
+    return (0, int(key)) if key.isdigit() else (1, key)
+
+def _aggregate_plan(aggregate: Dict[str, str]) -> List[Tuple[str, str, str]]:
+    # (output field, field it reads, operator); avg_age=$avg reads age
+    plan = []
+    for output_field, op in aggregate.items():
+        actual_field = output_field
+        for prefix in ("avg_", "sum_", "min_", "max_"):
+            if output_field.startswith(prefix):
+                actual_field = output_field[len(prefix):]
+                break
+        plan.append((output_field, actual_field, op))
+    return plan
+
+def validate_collection_name(name: str) -> str:
+    if not name or not _valid_name(name):
+        raise ValueError(f"Invalid collection name: {name}")
+    return name
+
+def validate_schema(schema: str) -> List[str]:
+    if not _SCHEMA_RE.fullmatch(schema):
+        raise ValueError(f"Invalid schema: {schema}")
+    # The full match guarantees only whitespace surrounds the commas
+    fields = _FIELD_SPLIT.split(schema.strip())
+    bad = _RESERVED.intersection(fields)
+    if bad:
+        raise ValueError(f"Invalid schema field: {next(iter(bad))}")
+    return fields
+
+def split_fields(text: str) -> List[str]:
+    fields = [field for field in _FIELD_SPLIT.split(text.strip()) if field]
+    bad = next((field for field in fields if not _valid_name(field)), None)
+    if bad is not None:
+        raise ValueError(f"Invalid field name: {bad}")
+    return fields
+
+class RWLock:
+    # Queries share the read side, writes hold the write side alone through `with lock:`.
+    # A waiting writer stops new readers from entering, so steady reads cannot starve it
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def acquire(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+
+    def release(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
 
 class MyDB:
     def __init__(self):
         self.collections: Dict[str, 'Collection'] = {}
-        self.lock = Lock()
+        # Guards the collections dict, each collection has a lock of its own
+        self.lock = RWLock()
+        # Snapshots and their uploads run one at a time
+        self.save_lock = Lock()
+        # Each collection lives in its own file, metadata_path lists them with their
+        # schema. file_path is the older single-file layout and is only ever read
+        self.metadata_path = "metadata.json"
+        self.collections_dir = "collections"
         self.file_path = "database.json"
-        self.last_save_time = 0
+        # Mutations are appended to the write-ahead log and folded into the
+        # collection files every snapshot_every operations
+        self.wal_path = "database.wal"
+        self.wal = None
+        self.wal_fsync = True
+        self.snapshot_every = 100
+        self.ops_since_snapshot = 0
+        # Logged operations are also folded in once the oldest is snapshot_age seconds old,
+        # so a quiet process still reaches the collection files and GitHub
+        self.snapshot_age = 60.0
+        self._wal_since: Optional[float] = None
+        self._snapshot_timer: Optional[Timer] = None
+        # Group commit: log lines queue up and are written with one fsync per save_interval
         self.save_interval = 1.0
-        self.cache = {}
+        self._pending_ops: List[bytes] = []
+        self._pending_lock = Lock()
+        self._flush_timer: Optional[Timer] = None
+        # Read results per collection, least recently used first
+        self.cache: Dict[str, OrderedDict] = {}
+        self.cache_max = 512
         self.collection_metadata = {}
+        self._metadata_bytes: Optional[bytes] = None
+        # Collections written since the last snapshot, only these files are rewritten
+        self._dirty: Set[str] = set()
+        # Parsed database.json, kept until every collection has taken its records
+        self._parsed_state: Optional[Dict] = None
         self.github_token = os.environ.get("GITHUB_TOKEN")
         self.github_repo = os.environ.get("GITHUB_REPO", "your-username/mydb-streamlit")
+        self._repo = None
+        # Saved paths GitHub has not taken yet
+        self._unpushed: Set[str] = set()
         self.load_metadata()
+        self.replay_wal()
+        self.wal = open(self.wal_path, "ab", buffering=0)
+        if self._wal_since is not None:
+            self._arm_snapshot(self.snapshot_age)
+        atexit.register(self.close)
 
-    def debounce_save(self):
-        current_time = time.time()
-        if current_time - self.last_save_time >= self.save_interval:
+    def log_ops(self, ops: List[Dict]):
+        if not ops:
+            return
+        lines = [_dumps(op) + b"\n" for op in ops]
+        with self._pending_lock:
+            self._pending_ops.extend(lines)
+            self._dirty.update(op["coll"] for op in ops)
+            self.ops_since_snapshot += len(ops)
+            if self._wal_since is None:
+                self._wal_since = time.monotonic()
+            if self._flush_timer is None:
+                self._flush_timer = Timer(self.save_interval, self.flush_and_snapshot)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def flush_and_snapshot(self):
+        # Runs on the timer thread, so writers never wait on the snapshot or its upload
+        self.flush_wal()
+        since = self._wal_since
+        if since is None:
+            return
+        wait = self.snapshot_age - (time.monotonic() - since)
+        if self.ops_since_snapshot >= self.snapshot_every or wait <= 0:
             self.save_to_file()
-            self.last_save_time = current_time
-            self.cache.clear()
+        else:
+            self._arm_snapshot(wait)
+
+    def _arm_snapshot(self, wait: float):
+        with self._pending_lock:
+            if self._snapshot_timer is None:
+                self._snapshot_timer = Timer(wait, self._snapshot_due)
+                self._snapshot_timer.daemon = True
+                self._snapshot_timer.start()
+
+    def _snapshot_due(self):
+        with self._pending_lock:
+            self._snapshot_timer = None
+        self.flush_and_snapshot()
+
+    def close(self):
+        # At exit the log alone is not enough, the container and its files may not come back
+        self.flush_wal()
+        if self._dirty or self._unpushed:
+            try:
+                self.save_to_file()
+            except Exception as e:
+                print(f"Failed to save database on exit: {e}")
+
+    @contextmanager
+    def read_locks(self, collections):
+        # Collection locks are always taken in name order, so two holders of several
+        # locks cannot end up waiting on each other
+        with ExitStack() as stack:
+            for collection in sorted(set(collections), key=operator.attrgetter("name")):
+                stack.enter_context(collection.lock.read())
+            yield
+
+    def invalidate(self, collection_name: str):
+        self.cache.pop(collection_name, None)
+
+    def flush_wal(self):
+        with self._pending_lock:
+            pending, self._pending_ops = self._pending_ops, []
+            self._flush_timer = None
+            if pending:
+                self.wal.write(b"".join(pending))
+                if self.wal_fsync:
+                    os.fsync(self.wal.fileno())
+
+    def replay_wal(self):
+        if not os.path.exists(self.wal_path):
+            return
+        touched = set()
+        good = 0
+        with open(self.wal_path, 'rb') as f:
+            for line in f:
+                # Every line is written whole with its newline, a torn write can only be the last one
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    op = _loads(line)
+                except ValueError:
+                    break
+                good += len(line)
+                self.ops_since_snapshot += 1
+                self._wal_since = time.monotonic()
+                name = op["coll"]
+                self._dirty.add(name)
+                if op["op"] == "create":
+                    if name not in self.collections:
+                        self.collections[name] = Collection(name, op["schema"], self)
+                        self.collection_metadata[name] = {"schema": op["schema"], "index_keys": []}
+                    continue
+                collection = self.collections[name]
+                collection.load_data()
+                if op["op"] == "put":
+                    collection.data[op["key"]] = op["rec"]
+                    collection._next_id = max(collection._next_id, int(op["key"]) + 1)
+                elif op["op"] == "del":
+                    collection.data.pop(op["key"], None)
+                elif op["op"] == "index":
+                    collection.indexes.setdefault(",".join(op["fields"]), {})
+                touched.add(collection)
+        if good < os.path.getsize(self.wal_path):
+            # Cut the torn tail off, or the next append would be glued onto it
+            with open(self.wal_path, 'r+b') as f:
+                f.truncate(good)
+                os.fsync(f.fileno())
+        for collection in touched:
+            for index_key in collection.indexes:
+                IndexManager.build_index(tuple(index_key.split(",")), collection.data, collection.indexes)
+
+    def collection_path(self, name: str) -> str:
+        return f"{self.collections_dir}/{name}.json"
+
+    def write_collection(self, f, collection: 'Collection'):
+        # Emit the JSON document one record at a time, so peak memory stays at a
+        # single encoded record instead of the whole collection
+        f.write(b'{"next_id": ' + _dumps(collection._next_id) + b', "data": {')
+        for i, (key, record) in enumerate(collection.data.items()):
+            if i:
+                f.write(b",")
+            f.write(b"\n" + _dumps(key) + b": " + _dumps(record))
+        f.write(b'\n}, "indexes": ' + _dumps(collection.indexes) + b"}\n")
+
+    def save_collection(self, name: str) -> str:
+        collection = self.collections[name]
+        if not collection.data_loaded:
+            collection.load_data()
+        path = self.collection_path(name)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            self.write_collection(f, collection)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.collection_metadata[name] = {"schema": collection.schema, "index_keys": list(collection.indexes)}
+        return path
+
+    def get_repo(self):
+        # Resolving the repository costs an API round-trip, do it once per database
+        if self._repo is None:
+            self._repo = Github(self.github_token).get_repo(self.github_repo)
+        return self._repo
 
     def save_to_file(self):
-        db_state = {}
-        for name, collection in self.collections.items():
-            db_state[name] = {
-                "schema": collection.schema,
-                "data": collection.data if collection.data_loaded else self.load_collection_data(name),
-                "indexes": {k: {vk: list(vv) for vk, vv in v.items()} for k, v in collection.indexes.items()}
-            }
-        try:
-            g = Github(self.github_token)
-            repo = g.get_repo(self.github_repo)
+        with self.save_lock:
+            # Writes are logged under their collection's lock, so with every collection
+            # held for reading the files take in exactly the logged operations
+            with self.lock.read(), self.read_locks(self.collections.values()):
+                with self._pending_lock:
+                    dirty, self._dirty = self._dirty, set()
+                os.makedirs(self.collections_dir, exist_ok=True)
+                for name in dirty:
+                    self._unpushed.add(self.save_collection(name))
+                metadata = _dumps(self.collection_metadata, indent=True)
+                if metadata != self._metadata_bytes:
+                    tmp_path = f"{self.metadata_path}.tmp"
+                    with open(tmp_path, 'wb') as f:
+                        f.write(metadata)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp_path, self.metadata_path)
+                    self._metadata_bytes = metadata
+                    self._unpushed.add(self.metadata_path)
+                # The collection files now hold every logged mutation, including any still queued.
+                # The renames must reach the disk before the log that could redo them is cut
+                if dirty:
+                    _fsync_dir(self.collections_dir)
+                _fsync_dir(os.path.dirname(os.path.abspath(self.metadata_path)))
+                with self._pending_lock:
+                    self._pending_ops = []
+                    if self.wal:
+                        os.ftruncate(self.wal.fileno(), 0)
+                    self.ops_since_snapshot = 0
+                    self._wal_since = None
+            # The upload reads the saved files, queries and writes go on meanwhile
             try:
-                file = repo.get_contents(self.file_path, ref="main")
-                repo.update_file(
-                    self.file_path,
-                    f"Update {self.file_path}",
-                    json.dumps(db_state, indent=2),
-                    file.sha,
-                    branch="main"
-                )
-            except:
-                repo.create_file(
-                    self.file_path,
-                    f"Create {self.file_path}",
-                    json.dumps(db_state, indent=2),
-                    branch="main"
-                )
-        except Exception as e:
-            raise Exception(f"Failed to save database to GitHub: {e}")
+                self.push_files()
+            except Exception as e:
+                raise Exception(f"Failed to save database to GitHub: {e}")
+
+    def push_files(self):
+        # Files that failed to push stay in _unpushed and go out with the next snapshot
+        changes = {}
+        for path in sorted(self._unpushed):
+            with open(path, 'rb') as f:
+                changes[path] = f.read()
+        if changes:
+            self._batch_commit(changes)
+            self._unpushed.difference_update(changes)
+
+    def _batch_commit(self, changes: Dict[str, bytes]):
+        # Every changed file goes into one tree on top of main and one commit,
+        # instead of a commit per file through the contents API
+        repo = self.get_repo()
+        with IndexManager.push_lock:
+            ref = repo.get_git_ref("heads/main")
+            parent = repo.get_git_commit(ref.object.sha)
+            elements = [InputGitTreeElement(path, "100644", "blob", content.decode()) for path, content in changes.items()]
+            tree = repo.create_git_tree(elements, parent.tree)
+            commit = repo.create_git_commit(f"Update {', '.join(changes)}", tree, [parent])
+            ref.edit(commit.sha)
+
+    def add_collection(self, name: str, schema: List[str], index_keys: List[str]):
+        self.collections[name] = Collection(name, schema, self)
+        self.collection_metadata[name] = {"schema": schema, "index_keys": index_keys}
 
     def load_metadata(self):
-        if os.path.exists(self.file_path):
+        if os.path.exists(self.metadata_path):
             try:
-                with open(self.file_path, 'r') as f:
-                    db_state = json.load(f)
+                with open(self.metadata_path, 'rb') as f:
+                    self._metadata_bytes = f.read()
+                for name, state in _loads(self._metadata_bytes).items():
+                    self.add_collection(name, state.get("schema", []), state.get("index_keys", []))
+            except Exception as e:
+                raise Exception(f"Failed to load metadata from {self.metadata_path}: {e}")
+        elif os.path.exists(self.file_path):
+            try:
+                with open(self.file_path, 'rb') as f:
+                    db_state = _loads(f.read())
+                self._parsed_state = db_state
                 for name, state in db_state.items():
-                    collection = Collection(name, state.get("schema", []), self)
-                    collection.indexes = {k: {vk: set(vv) for vk, vv in v.items()} for k, v in state.get("indexes", {}).items()}
-                    self.collections[name] = collection
-                    self.collection_metadata[name] = {
-                        "schema": state.get("schema", []),
-                        "data_loaded": False
-                    }
+                    self.add_collection(name, state.get("schema", []), list(state.get("indexes", {})))
+                # Every collection moves to its own file with the next snapshot
+                self._dirty.update(db_state)
             except Exception as e:
                 raise Exception(f"Failed to load metadata from {self.file_path}: {e}")
 
-    def load_collection_data(self, collection_name: str) -> Records:
-        if not os.path.exists(self.file_path):
-            return {}
-        try:
-            with open(self.file_path, 'r') as f:
-                db_state = json.load(f)
-            collection_data = db_state.get(collection_name, {}).get("data", {})
-            return collection_data
-        except Exception as e:
-            raise Exception(f"Failed to load data for {collection_name}: {e}")
+    def load_collection_data(self, collection_name: str) -> Dict:
+        path = self.collection_path(collection_name)
+        if os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    return _loads(f.read())
+            except Exception as e:
+                raise Exception(f"Failed to load data for {collection_name}: {e}")
+        if self._parsed_state is not None:
+            return self._parsed_state.get(collection_name, {})
+        return {}
+
+    def release_parsed_state(self):
+        # Collections not yet moved to their own file are read from the parsed
+        # database.json, so it is kept until every collection holds its own records
+        if all(c.data_loaded for c in self.collections.values()):
+            self._parsed_state = None
 
     def create_collection(self, name: str, schema: List[str] = None):
+        validate_collection_name(name)
         with self.lock:
             if name not in self.collections:
-                self.collections[name] = Collection(name, schema or [], self)
-                self.collection_metadata[name] = {"schema": schema or [], "data_loaded": False}
-                self.debounce_save()
+                self.add_collection(name, schema or [], [])
+                self.log_ops([{"op": "create", "coll": name, "schema": schema or []}])
                 return f"Collection {name} created"
             return f"Collection {name} already exists"
 
@@ -100,231 +565,454 @@ class Collection:
     def __init__(self, name: str, schema: List[str], db: 'MyDB'):
         self.name = name
         self.schema = schema
+        # Every insert checks its fields against this, the schema never changes after creation
+        self._schema_fields = frozenset(schema)
         self.db = db
         self.data: Records = None
         self.data_loaded = False
         self.indexes: Indexes = {}
-        self.lock = db.lock
+        # Ids are never reused, a deleted record's id stays retired
+        self._next_id = 1
+        self.lock = RWLock()
+        self.version = 0
+        self.rewrite_version = 0
+        # Queries share the read lock, so the lazily built state below (records, column
+        # snapshot, arrays, index views) is filled in under this one, checked twice
+        self._build_lock = RLock()
+        self._columns: Dict[str, List] = {}
+        self._columns_version = -1
+        self._columns_rows = 0
+        self._arrays: Dict[Tuple[str, bool], object] = {}
+        self._arrays_version = -1
+        self._index_views: Dict[Tuple[str, object], Tuple[int, object]] = {}
+        self._pending: List[Record] = []
+        self._wal_ops: List[Dict] = []
+        # Set by a committing transaction: the state of each key before its first write
+        self._undo: Optional[Dict[str, Optional[Record]]] = None
 
     def load_data(self):
-        if not self.data_loaded:
-            self.data = self.db.load_collection_data(self.name)
+        if self.data_loaded:
+            return
+        with self._build_lock:
+            if self.data_loaded:
+                return
+            state = self.db.load_collection_data(self.name)
+            data = state.get("data", {})
+            # Older files may hold padded strings, stored values are kept stripped
+            stripped = False
+            for record in data.values():
+                for field, value in record.items():
+                    if isinstance(value, str) and value != value.strip():
+                        record[field] = value.strip()
+                        stripped = True
+            self.indexes = {k: {vk: set(vv) for vk, vv in v.items()} for k, v in state.get("indexes", {}).items()}
+            if stripped:
+                # The saved buckets are keyed by the padded values, rebuild them and save the cleaned file
+                for index_key in list(self.indexes):
+                    IndexManager.build_index(tuple(index_key.split(",")), data, self.indexes)
+                with self.db._pending_lock:
+                    self.db._dirty.add(self.name)
+            # Files saved before the counter was kept continue after their highest id
+            self._next_id = state.get("next_id") or max((int(key) for key in data if key.isdigit()), default=0) + 1
+            self.data = data
             self.data_loaded = True
+            self.db.release_parsed_state()
+
+    def columns(self) -> Dict[str, List]:
+        if not self.data_loaded:
+            self.load_data()
+        if self._columns_version == self.version:
+            return self._columns
+        with self._build_lock:
+            return self._build_columns()
+
+    def _build_columns(self) -> Dict[str, List]:
+        if self._columns_version < self.rewrite_version:
+            # Rows were updated or deleted since the snapshot was built, start over
+            self._columns = {field: [] for field in self.schema + ["_id", "created_at"]}
+            self._columns_rows = 0
+        if self._columns_version != self.version:
+            # Only inserts happened since the snapshot, append the new tail rows
+            cols = self._columns
+            rows = self._columns_rows
+            for record in itertools.islice(self.data.values(), rows, None):
+                if not record.keys() <= cols.keys():
+                    for field in record:
+                        if field not in cols:
+                            cols[field] = [None] * rows
+                for field, values in cols.items():
+                    values.append(record.get(field))
+                rows += 1
+            self._columns_rows = rows
+            self._columns_version = self.version
+        return self._columns
+
+    def column_array(self, field: str, numeric: bool):
+        if self._arrays_version == self.version:
+            array = self._arrays.get((field, numeric))
+            if array is not None:
+                return array
+        with self._build_lock:
+            return self._build_array(field, numeric)
+
+    def _build_array(self, field: str, numeric: bool):
+        if self._arrays_version != self.version:
+            self._arrays = {}
+            self._arrays_version = self.version
+        array = self._arrays.get((field, numeric))
+        if array is None:
+            cols = self.columns()
+            values = cols.get(field) or [None] * self._columns_rows
+            if numeric:
+                # Missing and non-numeric values become NaN, which fails every comparison
+                array = np.array([None if v is None else _as_float(v) for v in values], dtype=np.float64)
+            else:
+                array = np.array([None if v is None else str(v) for v in values], dtype=object)
+            self._arrays[(field, numeric)] = array
+        return array
+
+    def match_mask(self, query: Dict):
+        mask = np.ones(len(self.columns()["_id"]), dtype=bool)
+        for key, condition in query.items():
+            if isinstance(condition, str):
+                mask &= self.column_array(key, False) == condition
+            elif isinstance(condition, dict):
+                if "$in" in condition:
+                    members = frozenset(str(v) for v in condition["$in"])
+                    strings = self.column_array(key, False)
+                    mask &= np.fromiter((v in members for v in strings), dtype=bool, count=len(strings))
+                    if len(condition) == 1:
+                        continue
+                nums = self.column_array(key, True)
+                mask &= ~np.isnan(nums)
+                for op, value in condition.items():
+                    if op == "$in":
+                        continue
+                    try:
+                        op_value = float(value)
+                    except (ValueError, TypeError):
+                        mask[:] = False
+                        return mask
+                    if op == "$gt":
+                        mask &= nums > op_value
+                    elif op == "$gte":
+                        mask &= nums >= op_value
+                    elif op == "$lt":
+                        mask &= nums < op_value
+                    elif op == "$lte":
+                        mask &= nums <= op_value
+        if "ttl" in self.columns():
+            # Few records carry a TTL, check just those the vector filter kept
+            ids = self._columns["_id"]
+            now = time.time()
+            for i in np.flatnonzero(mask & ~np.isnan(self.column_array("ttl", True))):
+                if self.is_expired(self.data[ids[i]], now):
+                    mask[i] = False
+        return mask
+
+    def scan(self, conditions: Dict) -> List[Record]:
+        if np is not None and len(self.data) >= _VECTOR_MIN_ROWS:
+            ids = self.columns()["_id"]
+            return [self.data[ids[i]] for i in np.flatnonzero(self.match_mask(conditions))]
+        match = self.matcher(conditions)
+        return [record for record in self.data.values() if match(record)]
 
     def current_time(self) -> str:
-        return datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        # Same text as strftime("%Y-%m-%dT%H:%M:%S") without parsing a format string
+        return datetime.now().isoformat(timespec="seconds")
 
     def parse_time(self, time_str: str) -> datetime:
-        return datetime.strptime(time_str, "%Y-%m-%dT%H:%M:%S")
+        # current_time writes isoformat text, read it back with the C parser instead of strptime
+        return datetime.fromisoformat(time_str)
 
-    def is_expired(self, record: Record) -> bool:
+    def is_expired(self, record: Record, now: Optional[float] = None) -> bool:
         if "ttl" not in record or "created_at" not in record:
             return False
         ttl = float(record["ttl"])
-        created = self.parse_time(record["created_at"])
-        return datetime.now() >= created + timedelta(seconds=ttl)
+        return (time.time() if now is None else now) >= _timestamp(record["created_at"]) + ttl
 
-    def validate_record(self, record: Data) -> bool:
+    def validate_record(self, record: Data) -> Dict[str, float]:
+        # Returns the numeric fields already parsed, so the insert does not parse them again
         if "_id" in record or "created_at" in record:
             raise ValueError("Cannot set reserved fields: _id, created_at")
         if self.schema:
             for field in self.schema:
-                if field not in record and field not in ["ttl", "updated_at"]:
+                if field not in record and field not in _OPTIONAL_FIELDS:
                     raise ValueError(f"Missing required field {field} in record: {record}")
+            schema = self._schema_fields
             for field in record:
-                if field not in self.schema and field not in ["ttl", "updated_at"]:
+                if field not in schema and field not in _OPTIONAL_FIELDS:
                     raise ValueError(f"Field {field} not in schema: {self.schema}")
-                if field == "age":
-                    try:
-                        float(record[field])
-                    except (ValueError, TypeError):
-                        raise ValueError(f"Field {field} must be numeric, got {record[field]}")
-        return True
+        coerced = {}
+        for field in _NUMERIC_FIELDS.intersection(record):
+            try:
+                coerced[field] = float(record[field])
+            except (ValueError, TypeError):
+                raise ValueError(f"Field {field} must be numeric, got {record[field]}")
+        return coerced
 
-    def match_query(self, record: Record, query: Dict, check_ttl: bool = True) -> bool:
-        if check_ttl and self.is_expired(record):
-            return False
+    def order_conditions(self, conditions: Dict) -> Dict:
+        # Cheapest checks first so match_query exits early: equality, then range checks, then
+        # $in lists. Within a tier, the fewest surviving rows first, read off the field's index:
+        # the bucket size for equality, the number of distinct values for ranges
+        def cost(item):
+            field, condition = item
+            index = self.indexes.get(field)
+            if isinstance(condition, str):
+                return (0, len(index.get(condition, ())) if index is not None else len(self.data or ()))
+            tier = 2 if isinstance(condition, dict) and "$in" in condition else 1
+            return (tier, -len(index or ()))
+        return dict(sorted(conditions.items(), key=cost))
+
+    def matcher(self, query: Dict, check_ttl: bool = True) -> Callable[[Record], bool]:
+        tests = []
         for key, condition in query.items():
-            record_value = record.get(key)
-            if record_value is None:
-                return False
             if isinstance(condition, str):
-                if str(record_value).strip() != condition:
-                    return False
+                tests.append(_equals_test(key, condition))
             elif isinstance(condition, dict):
-                ops = condition
-                try:
-                    record_num = float(str(record_value).strip())
-                except (ValueError, TypeError):
+                tests.append(_compare_test(key, condition))
+            else:
+                tests.append(_present_test(key))
+        is_expired = self.is_expired
+        # One clock reading per query, rows expire as of the moment it started
+        now = time.time()
+
+        def match(record):
+            if check_ttl and is_expired(record, now):
+                return False
+            for test in tests:
+                if not test(record):
                     return False
-                for op, value in ops.items():
-                    try:
-                        op_value = float(value)
-                        if op == "$gt" and not (record_num > op_value):
-                            return False
-                        elif op == "$gte" and not (record_num >= op_value):
-                            return False
-                        elif op == "$lt" and not (record_num < op_value):
-                            return False
-                        elif op == "$lte" and not (record_num <= op_value):
-                            return False
-                        elif op == "$in" and str(record_value) not in [str(v) for v in value]:
-                            return False
-                    except (ValueError, TypeError):
-                        return False
-        return True
+            return True
+        return match
+
+    def match_query(self, record: Record, query: Dict, check_ttl: bool = True) -> bool:
+        return self.matcher(query, check_ttl)(record)
 
     def insert(self, record: Data) -> str:
         with self.lock:
-            if not self.data_loaded:
-                self.load_data()
-            if not self.validate_record(record):
-                raise ValueError(f"Invalid record for schema: {self.schema}")
-            key = str(len(self.data) + 1)
-            record = record.copy()
-            record["_id"] = key
-            record["created_at"] = self.current_time()
-            for field in record:
-                if field == "age":
-                    try:
-                        record[field] = str(float(record[field]))
-                    except (ValueError, TypeError):
-                        raise ValueError(f"Field {field} must be numeric, got {record[field]}")
-                else:
-                    record[field] = str(record[field])
-            self.data[key] = record
-            for index_key in self.indexes:
-                fields = index_key.split(",")
-                IndexManager.build_index(tuple(fields), self.data, self.indexes)
-            self.db.debounce_save()
+            key = self._insert(record)
+            self._after_write(rewrite=False)
             return key
 
     def update(self, operations: Dict, update_data: Data) -> int:
         with self.lock:
-            if not self.data_loaded:
-                self.load_data()
-            count = 0
-            for key, record in self.data.items():
-                if self.match_query(record, operations):
-                    for field, value in update_data.items():
-                        if field == "age":
-                            try:
-                                update_data[field] = str(float(value))
-                            except (ValueError, TypeError):
-                                raise ValueError(f"Field {field} must be numeric, got {value}")
-                        else:
-                            update_data[field] = str(value)
-                    record.update(update_data)
-                    record["updated_at"] = self.current_time()
-                    count += 1
+            count = self._update(operations, update_data)
             if count > 0:
-                for index_key in self.indexes:
-                    fields = index_key.split(",")
-                    IndexManager.build_index(tuple(fields), self.data, self.indexes)
-            self.db.debounce_save()
+                self._after_write(rewrite=True)
             return count
 
     def delete(self, query: Dict) -> int:
         with self.lock:
-            if not self.data_loaded:
-                self.load_data()
-            to_delete = [key for key, record in self.data.items() if self.match_query(record, query)]
-            for key in to_delete:
-                del self.data[key]
-            if to_delete:
-                for index_key in self.indexes:
-                    fields = index_key.split(",")
-                    IndexManager.build_index(tuple(fields), self.data, self.indexes)
-            self.db.debounce_save()
-            return len(to_delete)
+            count = self._delete(query)
+            if count > 0:
+                self._after_write(rewrite=True)
+            return count
+
+    # The _insert/_update/_delete steps only touch self.data and expect the caller to
+    # hold self.lock and call _after_write once, so a transaction pays it once per commit.
+    # Inserts are staged in self._pending and promoted to self.data in one dict.update.
+    def _insert(self, record: Data) -> str:
+        if not self.data_loaded:
+            self.load_data()
+        coerced = self.validate_record(record)
+        key = str(self._next_id)
+        self._next_id += 1
+        # Strings are stored stripped, so filters compare them as they are. Field names are
+        # interned so every record of the collection shares one copy of each key
+        record = {sys.intern(field): str(value).strip() for field, value in record.items()}
+        record.update(coerced)
+        record["_id"] = key
+        record["created_at"] = self.current_time()
+        if self._undo is not None:
+            self._undo.setdefault(key, None)
+        self._pending.append(record)
+        for index_key in self.indexes:
+            IndexManager.add_record(tuple(index_key.split(",")), record, key, self.indexes)
+        self._wal_ops.append({"op": "put", "coll": self.name, "key": key, "rec": record})
+        return key
+
+    def _flush_pending(self):
+        if self._pending:
+            self.data.update({record["_id"]: record for record in self._pending})
+            self._pending.clear()
+
+    def _update(self, operations: Dict, update_data: Data) -> int:
+        if not self.data_loaded:
+            self.load_data()
+        self._flush_pending()
+        operations = self.order_conditions(operations)
+        match = self.matcher(operations)
+        # Only indexes over a written field need their buckets moved, updated_at is always written
+        written = update_data.keys() | {"updated_at"}
+        touched = [fields for fields in (tuple(index_key.split(",")) for index_key in self.indexes)
+                   if not written.isdisjoint(fields)]
+        # Coerce once into a copy, the caller's dict (possibly a cached Query's) is left as is
+        coerced = {}
+        for field, value in update_data.items():
+            if field in _NUMERIC_FIELDS:
+                try:
+                    coerced[sys.intern(field)] = float(value)
+                except (ValueError, TypeError):
+                    raise ValueError(f"Field {field} must be numeric, got {value}")
+            else:
+                coerced[sys.intern(field)] = str(value).strip()
+        coerced["updated_at"] = self.current_time()
+        count = 0
+        for key, record in self.data.items():
+            if match(record):
+                # Move the id only between buckets whose composite value actually changed
+                before = [IndexManager.composite_key(fields, record) for fields in touched]
+                if self._undo is not None:
+                    self._undo.setdefault(key, dict(record))
+                record.update(coerced)
+                for fields, old in zip(touched, before):
+                    if IndexManager.composite_key(fields, record) != old:
+                        IndexManager.discard(fields, old, key, self.indexes)
+                        IndexManager.add_record(fields, record, key, self.indexes)
+                self._wal_ops.append({"op": "put", "coll": self.name, "key": key, "rec": record})
+                count += 1
+        return count
+
+    def _delete(self, query: Dict) -> int:
+        if not self.data_loaded:
+            self.load_data()
+        self._flush_pending()
+        query = self.order_conditions(query)
+        match = self.matcher(query)
+        to_delete = [key for key, record in self.data.items() if match(record)]
+        for key in to_delete:
+            if self._undo is not None:
+                self._undo.setdefault(key, self.data[key])
+            for index_key in self.indexes:
+                IndexManager.remove_record(tuple(index_key.split(",")), self.data[key], key, self.indexes)
+            del self.data[key]
+            self._wal_ops.append({"op": "del", "coll": self.name, "key": key})
+        return len(to_delete)
+
+    def _after_write(self, rewrite: bool):
+        self._flush_pending()
+        self.version += 1
+        if rewrite:
+            self.rewrite_version = self.version
+        self.db.invalidate(self.name)
+        self.db.log_ops(self._wal_ops)
+        self._wal_ops = []
 
     def aggregate_query(self, aggregate: Dict, conditions: Dict, group_by: str, sort: Dict) -> List[Dict]:
         if not self.data_loaded:
             self.load_data()
+        conditions = self.order_conditions(conditions)
+        plan = _aggregate_plan(aggregate)
         results = []
-        if group_by:
-            groups = {}
-            matched_records = 0
-            for key, record in self.data.items():
-                if self.match_query(record, conditions):
-                    group_key = record.get(group_by, "null")
-                    if group_key not in groups:
-                        groups[group_key] = []
-                    groups[group_key].append(record)
-                    matched_records += 1
-            
-            for group_key, records in groups.items():
-                result = {"group": group_key}
-                for output_field, op in aggregate.items():
-                    actual_field = output_field
-                    for prefix in ["avg_", "sum_", "min_", "max_"]:
-                        if output_field.startswith(prefix):
-                            actual_field = output_field[len(prefix):]
-                            break
-                    values = []
-                    for r in records:
-                        if actual_field in r:
-                            record_value = r[actual_field]
-                            try:
-                                val = float(str(record_value).strip())
-                                values.append(val)
-                            except (ValueError, TypeError):
-                                pass
-                    if op == "$count":
-                        result[output_field] = len(records)
-                    elif values:
-                        if op == "$avg":
-                            result[output_field] = sum(values) / len(values)
-                        elif op == "$sum":
-                            result[output_field] = sum(values)
-                        elif op == "$min":
-                            result[output_field] = min(values)
-                        elif op == "$max":
-                            result[output_field] = max(values)
-                    else:
-                        result[output_field] = None if op in ["$avg", "$min", "$max"] else 0
-                results.append(result)
-        else:
+        vectorized = np is not None and len(self.data) >= _VECTOR_MIN_ROWS
+        if group_by and vectorized:
+            results = self.aggregate_groups(plan, conditions, group_by)
+        elif vectorized:
             result = {}
-            valid_records = [r for r in self.data.values() if self.match_query(r, conditions)]
-            for output_field, op in aggregate.items():
-                actual_field = output_field
-                for prefix in ["avg_", "sum_", "min_", "max_"]:
-                    if output_field.startswith(prefix):
-                        actual_field = output_field[len(prefix):]
-                        break
-                values = []
-                for r in valid_records:
-                    if actual_field in r:
-                        try:
-                            val = float(str(r[actual_field]).strip())
-                            values.append(val)
-                        except (ValueError, TypeError):
-                            pass
+            mask = self.match_mask(conditions)
+            matched = int(mask.sum())
+            for output_field, actual_field, op in plan:
                 if op == "$count":
-                    result[output_field] = len(valid_records)
-                elif values:
-                    if op == "$avg":
-                        result[output_field] = sum(values) / len(values)
+                    result[output_field] = matched
+                    continue
+                values = self.column_array(actual_field, True)[mask]
+                values = values[~np.isnan(values)]
+                if not values.size:
+                    result[output_field] = None if op in _NULL_AGGREGATES else 0
+                elif op in _ARRAY_REDUCERS:
+                    result[output_field] = float(getattr(values, _ARRAY_REDUCERS[op])())
+            results.append(result)
+        else:
+            # One pass over the matching rows, each (group, output) keeps running
+            # [sum, count, min, max] instead of collecting the rows and reparsing them per output
+            groups = {} if group_by else {None: [0, [[0.0, 0, None, None] for _ in plan]]}
+            for record in self.scan(conditions):
+                group_key = record.get(group_by, "null") if group_by else None
+                group = groups.get(group_key)
+                if group is None:
+                    group = groups[group_key] = [0, [[0.0, 0, None, None] for _ in plan]]
+                group[0] += 1
+                for (output_field, actual_field, op), acc in zip(plan, group[1]):
+                    value = record.get(actual_field)
+                    if value is None or op == "$count":
+                        continue
+                    num = _as_float(value)
+                    if num is None:
+                        continue
+                    acc[0] += num
+                    acc[1] += 1
+                    if acc[2] is None or num < acc[2]:
+                        acc[2] = num
+                    if acc[3] is None or num > acc[3]:
+                        acc[3] = num
+            for group_key, (count, accs) in groups.items():
+                result = {"group": group_key} if group_by else {}
+                for (output_field, actual_field, op), (total, found, low, high) in zip(plan, accs):
+                    if op == "$count":
+                        result[output_field] = count
+                    elif not found:
+                        result[output_field] = None if op in _NULL_AGGREGATES else 0
+                    elif op == "$avg":
+                        result[output_field] = total / found
                     elif op == "$sum":
-                        result[output_field] = sum(values)
+                        result[output_field] = total
                     elif op == "$min":
-                        result[output_field] = min(values)
+                        result[output_field] = low
                     elif op == "$max":
-                        result[output_field] = max(values)
-                else:
-                    result[output_field] = None if op in ["$avg", "$min", "$max"] else 0
-            results.append(result)
+                        result[output_field] = high
+                results.append(result)
 
         if sort:
             field, order = list(sort.items())[0]
-            results.sort(key=lambda x: x.get(field, 0) or 0, reverse=(order == "desc"))
+            results.sort(key=_typed_sort_key(results, field, lambda x: x.get(field, 0) or 0), reverse=(order == "desc"))
         
         return results
 
+    def aggregate_groups(self, plan: List[Tuple[str, str, str]], conditions: Dict, group_by: str) -> List[Dict]:
+        # GROUP BY over the column arrays: every row gets the number of its group, and each
+        # aggregate is one bincount (or ufunc.at) over those numbers instead of a loop per group
+        mask = self.match_mask(conditions)
+        rows = np.flatnonzero(mask)
+        keys = self.columns().get(group_by) or [None] * self._columns_rows
+        # Groups are numbered in order of first appearance like the row loop. A dict needs no
+        # ordering between keys, which may mix strings ("null", legacy ages) with floats
+        ids = {}
+        codes = [ids.setdefault("null" if keys[i] is None else keys[i], len(ids)) for i in rows]
+        if not codes:
+            return []
+        inverse = np.array(codes, dtype=np.intp)
+        names = list(ids)
+        count = np.bincount(inverse, minlength=len(names))
+        results = [{"group": name} for name in names]
+        for output_field, actual_field, op in plan:
+            if op == "$count":
+                for result, n in zip(results, count):
+                    result[output_field] = int(n)
+                continue
+            values = self.column_array(actual_field, True)[mask]
+            valid = ~np.isnan(values)
+            groups, values = inverse[valid], values[valid]
+            found = np.bincount(groups, minlength=len(names))
+            if op in ("$avg", "$sum"):
+                totals = np.bincount(groups, weights=values, minlength=len(names))
+                column = totals / np.maximum(found, 1) if op == "$avg" else totals
+            elif op in ("$min", "$max"):
+                column = np.full(len(names), np.inf if op == "$min" else -np.inf)
+                (np.minimum if op == "$min" else np.maximum).at(column, groups, values)
+            else:
+                column = None
+            for i, result in enumerate(results):
+                if not found[i]:
+                    result[output_field] = None if op in _NULL_AGGREGATES else 0
+                elif column is not None:
+                    result[output_field] = float(column[i])
+        return results
+
     def join_query(self, join: Dict, conditions: Dict) -> List[Dict]:
         if not self.data_loaded:
             self.load_data()
+        conditions = self.order_conditions(conditions)
         results = []
         other_collection = self.db.collections.get(join["collection"])
         if not other_collection:
@@ -334,64 +1022,166 @@ class Collection:
             other_collection.load_data()
         
         field1, field2 = join["on"].split("=")
+        # Hash join: bucket the live right-hand records by join value once, then probe per
+        # left record. Each bucket holds the prefixed copies, so they are built only once
+        prefix = f"{join['collection']}_"
+        buckets = {}
+        now = time.time()
+        for record2 in other_collection.data.values():
+            if not other_collection.is_expired(record2, now):
+                buckets.setdefault(record2.get(field2), []).append({prefix + k: v for k, v in record2.items()})
+        match = self.matcher(conditions, check_ttl=True)
         for key1, record1 in self.data.items():
-            if self.match_query(record1, conditions, check_ttl=True):
-                for key2, record2 in other_collection.data.items():
-                    if other_collection.match_query(record2, {}, check_ttl=True):
-                        if record1.get(field1) == record2.get(field2):
-                            joined_record = {**record1, **{f"{join['collection']}_{k}": v for k, v in record2.items()}}
-                            results.append(joined_record)
+            matches = buckets.get(record1.get(field1))
+            if matches and match(record1):
+                for prefixed in matches:
+                    joined_record = record1.copy()
+                    joined_record.update(prefixed)
+                    results.append(joined_record)
+        return results
+
+    def index_view(self, index_key: str, build) -> object:
+        # Structures derived from an index are rebuilt lazily, once per collection version
+        version, view = self._index_views.get((index_key, build), (-1, None))
+        if version == self.version:
+            return view
+        with self._build_lock:
+            version, view = self._index_views.get((index_key, build), (-1, None))
+            if version != self.version:
+                view = build(self.indexes[index_key])
+                self._index_views[(index_key, build)] = (self.version, view)
+            return view
+
+    def intersect_scan(self, conditions: Dict) -> Optional[List[Record]]:
+        # Equalities on two or more separately indexed fields: intersect their buckets,
+        # smallest first, and check the remaining conditions on the ids left over
+        buckets = []
+        covered = []
+        for field, condition in conditions.items():
+            if isinstance(condition, str) and field in self.indexes:
+                buckets.append(self.indexes[field].get(condition))
+                covered.append(field)
+        if len(buckets) < 2:
+            return None
+        if None in buckets:
+            # Every record holding the field is indexed, so nothing can match
+            return []
+        buckets.sort(key=len)
+        match = self.matcher(_residual_conditions(conditions, covered))
+        results = []
+        for key in sorted(buckets[0].intersection(*buckets[1:]), key=_id_order):
+            record = self.data.get(key)
+            if record and match(record):
+                results.append(record)
+        return results
+
+    def range_scan(self, conditions: Dict) -> Optional[List[Record]]:
+        # Walk only the index buckets inside the range, found by bisecting the sorted keys
+        for field, condition in conditions.items():
+            if isinstance(condition, dict) and field in self.indexes and not _RANGE_OPS.isdisjoint(condition):
+                ordered = self.index_view(field, IndexManager.sorted_keys)
+                match = self.matcher(conditions)
+                results = []
+                for key in sorted(IndexManager.range_lookup(ordered, self.indexes[field], condition), key=_id_order):
+                    record = self.data.get(key)
+                    if record and match(record):
+                        results.append(record)
+                return results
+        return None
+
+    def skip_scan(self, conditions: Dict) -> Optional[List[Record]]:
+        # Use a composite index (a,b,...) when the equality filter covers every field but the
+        # leading one: probe once per distinct prefix value instead of scanning every record
+        equals = {field: value for field, value in conditions.items() if isinstance(value, str)}
+        best = None
+        for index_key, index in self.indexes.items():
+            fields = index_key.split(",")
+            if len(fields) < 2 or fields[0] in equals or not all(field in equals for field in fields[1:]):
+                continue
+            prefixes = self.index_view(index_key, IndexManager.prefix_values)
+            # One probe per distinct prefix must beat a full scan
+            if len(prefixes) < len(self.data) and (best is None or len(prefixes) < len(best[2])):
+                best = (index, fields, prefixes)
+        if best is None:
+            return None
+        index, fields, prefixes = best
+        suffix = "|".join(equals[field] for field in fields[1:])
+        match = self.matcher(conditions)
+        results = []
+        for prefix in prefixes:
+            for key in index.get(f"{prefix}|{suffix}", ()):
+                record = self.data.get(key)
+                if record and match(record):
+                    results.append(record)
+        return results
+
+    def select_query(self, query: Query) -> List[Record]:
+        # Indexes are stored with the records, so they are only there once loaded
+        if not self.data_loaded:
+            self.load_data()
+        results = []
+        indexed = False
+        conditions = self.order_conditions(query.conditions)
+        if query.filter and query.filter["type"] == "compare":
+            fields = [query.filter.get("field")]
+            if len(query.conditions) > 1:
+                condition_fields = sorted(query.conditions.keys())
+                index_key = ",".join(condition_fields)
+                if index_key in self.indexes:
+                    composite_value = "|".join(str(query.conditions[field]) for field in condition_fields)
+                    if composite_value in self.indexes.get(index_key, {}):
+                        # The bucket already satisfies every equality on the index fields
+                        residual = self.matcher(_residual_conditions(conditions, condition_fields))
+                        for key in self.indexes[index_key][composite_value]:
+                            record = self.data.get(key)
+                            if record and residual(record):
+                                results.append(record)
+                        indexed = True
+            elif fields[0] in self.indexes and query.filter["operator"] == "=":
+                value = query.filter["value"]
+                if value in self.indexes.get(fields[0], {}):
+                    residual = self.matcher(_residual_conditions(conditions, fields))
+                    for key in self.indexes[fields[0]][value]:
+                        record = self.data.get(key)
+                        if record and residual(record):
+                            results.append(record)
+                    indexed = True
+        if not indexed:
+            planned = self.intersect_scan(conditions)
+            if planned is None:
+                planned = self.range_scan(conditions)
+            if planned is None:
+                planned = self.skip_scan(conditions)
+            if planned is not None:
+                results = planned
+            else:
+                results = self.scan(conditions)
+        if query.sort:
+            field, order = list(query.sort.items())[0]
+            results.sort(key=_typed_sort_key(results, field, lambda x: _sort_key(x.get(field, ""))), reverse=(order == "desc"))
         return results
 
     def parse_query(self, query_str: str) -> Dict:
         start_time = time.time()
-        query_key = f"{self.name}:{query_str}"
-        if query_key in self.db.cache:
-            end_time = time.time()
-            return {"results": self.db.cache[query_key], "execution_time": end_time - start_time}
+        cache = self.db.cache.setdefault(self.name, OrderedDict())
+        entry = cache.get(query_str)
+        if entry is not None:
+            # A join result also depends on the other collection, so check every version
+            sources, versions, results = entry
+            if tuple(source.version for source in sources) == versions:
+                cache.move_to_end(query_str)
+                end_time = time.time()
+                return {"results": results, "execution_time": end_time - start_time}
 
-        query = parse_my_query(query_str)
+        query = _parse_cached(query_str)
         results = []
-        indexed = False
 
         if query.action == QueryAction.INSERT:
             key = self.insert(query.data)
             results = [{"_id": key, **query.data}]
         elif query.action == QueryAction.SELECT:
-            if query.filter and query.filter["type"] == "compare":
-                fields = [query.filter.get("field")]
-                if len(query.conditions) > 1:
-                    condition_fields = sorted(query.conditions.keys())
-                    index_key = ",".join(condition_fields)
-                    if index_key in self.indexes:
-                        composite_value = "|".join(str(query.conditions[field]) for field in condition_fields)
-                        if composite_value in self.indexes.get(index_key, {}):
-                            if not self.data_loaded:
-                                self.load_data()
-                            for key in self.indexes[index_key][composite_value]:
-                                record = self.data.get(key)
-                                if record and self.match_query(record, query.conditions):
-                                    results.append(record)
-                            indexed = True
-                elif fields[0] in self.indexes and query.filter["operator"] == "=":
-                    value = query.filter["value"]
-                    if value in self.indexes.get(fields[0], {}):
-                        if not self.data_loaded:
-                            self.load_data()
-                        for key in self.indexes[fields[0]][value]:
-                            record = self.data.get(key)
-                            if record and self.match_query(record, query.conditions):
-                                results.append(record)
-                        indexed = True
-            if not indexed:
-                if not self.data_loaded:
-                    self.load_data()
-                for key, record in self.data.items():
-                    if self.match_query(record, query.conditions):
-                        results.append(record)
-            if query.sort:
-                field, order = list(query.sort.items())[0]
-                results.sort(key=lambda x: float(x.get(field, 0)) if str(x.get(field, '')).replace('.','',1).isdigit() else x.get(field, ''), reverse=(order == "desc"))
+            with self.lock.read():
+                results = self.select_query(query)
         elif query.action == QueryAction.UPDATE:
             count = self.update(query.conditions, query.data)
             results = [{"updated": count}]
@@ -403,33 +1193,55 @@ class Collection:
             self.create_index(fields)
             results = [{"indexed": ",".join(fields)}]
         elif query.action == QueryAction.TRANSACT:
-            from transaction import Transaction
-            tx = Transaction(self)
-            try:
-                for op_type, conditions, data in query.transact_ops:
-                    if op_type == "INSERT":
-                        tx.insert(data)
-                    elif op_type == "UPDATE":
-                        tx.update(conditions, data)
-                    elif op_type == "DELETE":
-                        tx.delete(conditions)
-                tx.commit()
-                results = [{"transaction": "committed"}]
-            except:
-                tx.rollback()
-                results = [{"transaction": "rolled back"}]
+            results = self.run_transaction(query.transact_ops)
         elif query.action == QueryAction.AGGREGATE:
-            results = self.aggregate_query(query.aggregate, query.conditions, query.group_by, query.sort)
+            with self.lock.read():
+                results = self.aggregate_query(query.aggregate, query.conditions, query.group_by, query.sort)
         elif query.action == QueryAction.JOIN:
-            results = self.join_query(query.join, query.conditions)
+            other = self.db.collections.get(query.join["collection"])
+            with self.db.read_locks([self, other] if other else [self]):
+                results = self.join_query(query.join, query.conditions)
 
-        self.db.cache[query_key] = results
+        if query.action in _CACHED_ACTIONS:
+            sources = (self,)
+            if query.action == QueryAction.JOIN and query.join["collection"] in self.db.collections:
+                sources += (self.db.collections[query.join["collection"]],)
+            cache[query_str] = (sources, tuple(source.version for source in sources), results)
+            if len(cache) > self.db.cache_max:
+                cache.popitem(last=False)
         end_time = time.time()
         return {"results": results, "execution_time": end_time - start_time}
 
-    def create_index(self, fields: Tuple[str, ...]):
+    def parse_query_batch(self, ops: List[str]) -> Dict:
+        start_time = time.time()
+        results = self.run_transaction([parse_transact_op(op) for op in ops])
+        end_time = time.time()
+        return {"results": results, "execution_time": end_time - start_time}
+
+    def run_transaction(self, ops: List[Tuple[str, Dict, Data]]) -> List[Dict]:
+        from transaction import Transaction
         if not self.data_loaded:
             self.load_data()
-        index_key = ",".join(fields)
-        IndexManager.build_index(fields, self.data, self.indexes)
-        self.db.debounce_save()
+        tx = Transaction(self)
+        try:
+            for op_type, conditions, data in ops:
+                if op_type == "INSERT":
+                    tx.insert(data)
+                elif op_type == "UPDATE":
+                    tx.update(conditions, data)
+                elif op_type == "DELETE":
+                    tx.delete(conditions)
+            tx.commit()
+            return [{"transaction": "committed"}]
+        except Exception:
+            # commit has already rolled back under the write lock
+            return [{"transaction": "rolled back"}]
+
+    def create_index(self, fields: Tuple[str, ...]):
+        with self.lock:
+            if not self.data_loaded:
+                self.load_data()
+            index_key = ",".join(fields)
+            IndexManager.build_index(fields, self.data, self.indexes)
+            self._index_views = {view_key: view for view_key, view in self._index_views.items() if view_key[0] != index_key}
+            self.db.log_ops([{"op": "index", "coll": self.name, "fields": list(fields)}])
@@ -1,54 +1,165 @@
-from typing import Dict, Tuple
-from mydb_types import Records, Indexes
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from mydb_types import Record, Records, Index, Indexes
 from collections import defaultdict
-from github import Github
+from github import Github, InputGitTreeElement
+from threading import Lock, Timer
+import atexit
+import functools
 import json
+import math
+import operator
 import os
+import sys
 import time
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Without orjson, one compact encoder is built at import instead of an indenting one per call
+_ENCODER = json.JSONEncoder(default=list, separators=(",", ":"), check_circular=False, ensure_ascii=False)
+
+def _dumps(obj) -> bytes:
+    # Buckets that reach the encoder as sets are written as lists
+    if orjson is not None:
+        return orjson.dumps(obj, default=list, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return _ENCODER.encode(obj).encode()
+
+@functools.lru_cache(maxsize=4)
+def _get_repo(github_token: Optional[str], github_repo: str):
+    # Resolving the repository costs an API round-trip, do it once per token and name
+    return Github(github_token).get_repo(github_repo)
+
 class IndexManager:
+    # Encoded index files waiting for the next push, keyed by path
+    _pending: Dict[str, bytes] = {}
+    _pending_lock = Lock()
+    _flush_timer: Optional[Timer] = None
+    flush_delay = 0.5
+    # Index and database pushes both move heads/main, one at a time so neither loses the race
+    push_lock = Lock()
+
     @staticmethod
     def build_index(fields: Tuple[str, ...], data: Records, indexes: Indexes):
         index = defaultdict(set)
+        # Record keys are interned, so the lookups below compare by identity. A record
+        # missing any of the fields raises KeyError and is left out of the index
+        getter = operator.itemgetter(*(sys.intern(field) for field in fields))
+        if len(fields) == 1:
+            key_of = str
+        elif len(fields) == 2:
+            key_of = lambda values: f"{values[0]}|{values[1]}"
+        else:
+            key_of = lambda values: "|".join(map(str, values))
         for id_, record in data.items():
-            if all(field in record for field in fields):
-                composite_key = "|".join(str(record[field]) for field in fields)
-                index[composite_key].add(id_)
+            try:
+                composite_key = key_of(getter(record))
+            except KeyError:
+                continue
+            index[composite_key].add(id_)
         index_key = ",".join(fields)
         indexes[index_key] = dict(index)
         IndexManager.save_index_to_file(indexes[index_key], index_key)
 
+    @staticmethod
+    def composite_key(fields: Tuple[str, ...], record: Record) -> Optional[str]:
+        # The containment test and the join both run in C, this is on every write path
+        if all(map(record.__contains__, fields)):
+            return "|".join(map(str, map(record.__getitem__, fields)))
+        return None
+
+    @staticmethod
+    def add_record(fields: Tuple[str, ...], record: Record, key: str, indexes: Indexes):
+        composite_key = IndexManager.composite_key(fields, record)
+        if composite_key is not None:
+            indexes[",".join(fields)].setdefault(composite_key, set()).add(key)
+
+    @staticmethod
+    def remove_record(fields: Tuple[str, ...], record: Record, key: str, indexes: Indexes):
+        IndexManager.discard(fields, IndexManager.composite_key(fields, record), key, indexes)
+
+    @staticmethod
+    def discard(fields: Tuple[str, ...], composite_key: Optional[str], key: str, indexes: Indexes):
+        if composite_key is not None:
+            index = indexes[",".join(fields)]
+            ids = index.get(composite_key)
+            if ids is not None:
+                ids.discard(key)
+                # Drop empty buckets so prefix and range views only see live values
+                if not ids:
+                    del index[composite_key]
+
+    @staticmethod
+    def prefix_values(index: Index) -> Set[str]:
+        return {composite_key.split("|", 1)[0] for composite_key in index}
+
+    @staticmethod
+    def sorted_keys(index: Index) -> Tuple[List[float], List[str]]:
+        numeric = []
+        for composite_key in index:
+            try:
+                value = float(composite_key)
+            except ValueError:
+                continue
+            # A NaN key would break the ordering bisect relies on, and matches no range
+            if not math.isnan(value):
+                numeric.append((value, composite_key))
+        numeric.sort()
+        return [value for value, _ in numeric], [key for _, key in numeric]
+
+    @staticmethod
+    def range_lookup(ordered: Tuple[List[float], List[str]], index: Index, ops: Dict[str, float]) -> Iterator[str]:
+        values, keys = ordered
+        start, end = 0, len(values)
+        if "$gt" in ops:
+            start = max(start, bisect_right(values, ops["$gt"]))
+        if "$gte" in ops:
+            start = max(start, bisect_left(values, ops["$gte"]))
+        if "$lt" in ops:
+            end = min(end, bisect_left(values, ops["$lt"]))
+        if "$lte" in ops:
+            end = min(end, bisect_right(values, ops["$lte"]))
+        for composite_key in keys[start:end]:
+            yield from index[composite_key]
+
     @staticmethod
     def save_index_to_file(index: Dict, index_key: str):
-        index_file = "index_db.json"
+        # Encoded now, while the caller still holds the collection lock. Every index saved
+        # before the timer fires goes out in the same commit
+        with IndexManager._pending_lock:
+            IndexManager._pending[f"index_db/{index_key}.json"] = _dumps(index)
+            if IndexManager._flush_timer is None:
+                IndexManager._flush_timer = Timer(IndexManager.flush_delay, IndexManager.flush_index_files)
+                IndexManager._flush_timer.daemon = True
+                IndexManager._flush_timer.start()
+
+    @staticmethod
+    def flush_index_files():
+        with IndexManager._pending_lock:
+            pending, IndexManager._pending = IndexManager._pending, {}
+            IndexManager._flush_timer = None
+        if not pending:
+            return
         try:
-            existing_index = {}
             github_token = os.environ.get("GITHUB_TOKEN")
             github_repo = os.environ.get("GITHUB_REPO", "your-username/mydb-streamlit")
-            g = Github(github_token)
-            repo = g.get_repo(github_repo)
-            try:
-                file = repo.get_contents(index_file, ref="main")
-                existing_index = json.loads(file.decoded_content.decode())
-            except:
-                pass
-            existing_index[index_key] = {k: list(v) for k, v in index.items()}
-            try:
-                file = repo.get_contents(index_file, ref="main")
-                repo.update_file(
-                    index_file,
-                    f"Update {index_file}",
-                    json.dumps(existing_index, indent=2),
-                    file.sha,
-                    branch="main"
-                )
-            except:
-                repo.create_file(
-                    index_file,
-                    f"Create {index_file}",
-                    json.dumps(existing_index, indent=2),
-                    branch="main"
-                )
-            print(f"Index for {index_key} saved to GitHub")
+            repo = _get_repo(github_token, github_repo)
+            with IndexManager.push_lock:
+                ref = repo.get_git_ref("heads/main")
+                parent = repo.get_git_commit(ref.object.sha)
+                elements = [InputGitTreeElement(path, "100644", "blob", content.decode()) for path, content in pending.items()]
+                tree = repo.create_git_tree(elements, parent.tree)
+                commit = repo.create_git_commit(f"Update {', '.join(pending)}", tree, [parent])
+                ref.edit(commit.sha)
+            print(f"Indexes saved to GitHub: {', '.join(pending)}")
         except Exception as e:
+            # Put the files back for the next push, unless a newer version was saved meanwhile
+            with IndexManager._pending_lock:
+                for path, content in pending.items():
+                    IndexManager._pending.setdefault(path, content)
             print(f"Failed to save index to GitHub: {e}")
+
+# Indexes still waiting on the timer are pushed before the process exits
+atexit.register(IndexManager.flush_index_files)
@@ -13,6 +13,9 @@ class QueryAction(Enum):
     JOIN = "JOIN"
 
 class Query:
+    __slots__ = ("action", "conditions", "data", "index_field", "transact_ops", "filter",
+                 "aggregate", "group_by", "sort", "join")
+
     def __init__(self):
         self.action: QueryAction = None
         self.conditions: Conditions = {}
@@ -1,85 +1,185 @@
 import re
+from typing import List, Tuple
 from query import Query, QueryAction
 from mydb_types import Conditions, Data
 
-def parse_my_query(query: str) -> Query:
-    q = Query()
+# Statement patterns, compiled once at import rather than looked up per parse
+_ADD_RE = re.compile(r"ADD DATA \((.+)\)", re.I)
+_FETCH_RE = re.compile(r"FETCH(?: FILTER \((.+)\))?", re.I)
+_MODIFY_RE = re.compile(r"MODIFY FILTER \((.+)\) WITH \((.+)\)", re.I)
+_REMOVE_RE = re.compile(r"REMOVE FILTER \((.+)\)", re.I)
+_INDEX_RE = re.compile(r"INDEX FIELD ([\w,]+)", re.I)
+_TRANSACT_RE = re.compile(r"TRANSACT OPS \((.+)\)", re.I)
+# The aggregate list never contains parentheses, so [^)]+ stops at its closing paren
+# instead of backtracking from the end of the query (which swallowed the FILTER clause)
+_AGGREGATE_RE = re.compile(r"AGGREGATE \(([^)]+)\)(?: FILTER \((.+)\))?(?: GROUP BY (\w+))?(?: SORT BY (\w+):(\w+))?", re.I)
+_JOIN_RE = re.compile(r"JOIN (\w+) ON (\w+)=(\w+)(?: FILTER \((.+)\))?", re.I)
 
-    def parse_filter(text: str) -> dict:
-        result = {"type": "compare", "field": "", "operator": "", "value": ""}
-        match = re.match(r"(\w+)\s*([=><!]+)\s*('[^']*'|[0-9.]+)", text)
-        if match:
-            field, op, value = match.groups()
-            result["field"] = field
-            result["operator"] = op
-            result["value"] = value[1:-1] if value.startswith("'") else float(value)
-        return result
+# Clause patterns
+_FILTER_RE = re.compile(r"(\w+)\s*([=><!]+)\s*('[^']*'|[0-9.]+)")
+_COND_RE = re.compile(r"(\w+)\s*([=><!]+|[$]\w+)\s*('[^']*'|[0-9.]+|\{[^{}]*\})")
+_INNER_OP_RE = re.compile(r"([$]?\w+)\s*:\s*([0-9.]+|\[[^\]]*\])")
+_LIST_ITEM_RE = re.compile(r""""([^"]*)"|'([^']*)'|([0-9.]+)""")
+_KV_RE = re.compile(r"(\w+)=('[^']*'|[0-9.]+)")
+_AGG_FIELD_RE = re.compile(r"(\w+)=([$]\w+)")
+
+# Comparison operators written inline, e.g. FETCH FILTER (age>=10, age<=50)
+_COMPARE_OPS = {">": "$gt", ">=": "$gte", "<": "$lt", "<=": "$lte"}
+
+# Only the characters that change the splitter state, everything else is skipped in C
+_OP_TOKEN_RE = re.compile(r"[();']")
+
+def split_ops(text: str) -> List[str]:
+    ops = []
+    depth = 0
+    quoted = False
+    start = 0
+    for token in _OP_TOKEN_RE.finditer(text):
+        ch = token.group()
+        if ch == "'":
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+            if depth < 0:
+                raise ValueError("Invalid query: unbalanced parentheses")
+        elif depth == 0:
+            ops.append(text[start:token.start()].strip())
+            start = token.end()
+    if depth or quoted:
+        raise ValueError("Invalid query: unbalanced parentheses or quotes")
+    ops.append(text[start:].strip())
+    return [op for op in ops if op]
 
-    def parse_conditions(text: str) -> dict:
-        result = {}
-        if not text:
-            return result
-        for pair in re.finditer(r"(\w+)\s*([=><!]+|[$]\w+)\s*('[^']*'|[0-9.]+|\{[^{}]*\})", text):
-            key, op, value = pair.groups()
-            if value.startswith("'") and value.endswith("'"):
-                result[key] = value[1:-1]
-            elif value.startswith("{"):
-                ops = {}
-                inner = value[1:-1]
-                for op_match in re.finditer(r"(\w+)\s*:\s*([0-9.]+|\[[^\]]*\])", inner):
-                    op_key, op_value = op_match.groups()
-                    if op_value.startswith("["):
-                        values = re.findall(r'"([^"]+)"', op_value[1:-1])
-                        ops[op_key] = values
-                    else:
-                        ops[op_key] = float(op_value)
-                result[key] = ops
-            else:
-                result[key] = value
+def parse_transact_op(op: str) -> Tuple[str, Conditions, Data]:
+    sub = parse_my_query(op)
+    if sub.action == QueryAction.INSERT:
+        return ("INSERT", {}, sub.data)
+    elif sub.action == QueryAction.UPDATE:
+        return ("UPDATE", sub.conditions, sub.data)
+    elif sub.action == QueryAction.DELETE:
+        return ("DELETE", sub.conditions, {})
+    raise ValueError(f"Invalid transaction operation: {op}")
+
+def parse_filter(text: str) -> dict:
+    result = {"type": "compare", "field": "", "operator": "", "value": ""}
+    match = _FILTER_RE.match(text)
+    if match:
+        field, op, value = match.groups()
+        result["field"] = field
+        result["operator"] = op
+        result["value"] = value[1:-1] if value.startswith("'") else float(value)
+    return result
+
+def parse_conditions(text: str) -> dict:
+    result = {}
+    if not text:
         return result
+    for pair in _COND_RE.finditer(text):
+        key, op, value = pair.groups()
+        if op in _COMPARE_OPS and not value.startswith("{"):
+            ops = result.get(key)
+            if not isinstance(ops, dict):
+                ops = result[key] = {}
+            try:
+                ops[_COMPARE_OPS[op]] = float(value.strip("'"))
+            except ValueError:
+                raise ValueError(f"Field {key} must be compared to a number, got {value}")
+        elif value.startswith("'") and value.endswith("'"):
+            result[key] = value[1:-1]
+        elif value.startswith("{"):
+            ops = {}
+            inner = value[1:-1]
+            for op_match in _INNER_OP_RE.finditer(inner):
+                op_key, op_value = op_match.groups()
+                if not op_key.startswith("$"):
+                    op_key = f"${op_key}"
+                if op_value.startswith("["):
+                    # Quoted items stay strings, bare numbers become floats like stored numeric fields
+                    values = []
+                    for double, single, number in _LIST_ITEM_RE.findall(op_value[1:-1]):
+                        if number:
+                            try:
+                                values.append(float(number))
+                            except ValueError:
+                                raise ValueError(f"Field {key} has an invalid list item {number}")
+                        else:
+                            values.append(double or single)
+                    ops[op_key] = values
+                else:
+                    ops[op_key] = float(op_value)
+            result[key] = ops
+        else:
+            result[key] = value
+    return result
 
-    if m := re.match(r"ADD DATA \((.+)\)", query, re.I):
-        q.action = QueryAction.INSERT
-        q.data = {k: v[1:-1] if v.startswith("'") else v for k, v in re.findall(r"(\w+)=('[^']*'|[0-9.]+)", m.group(1))}
-    elif m := re.match(r"FETCH(?: FILTER \((.+)\))?", query, re.I):
-        q.action = QueryAction.SELECT
-        if m.group(1):
-            q.filter = parse_filter(m.group(1))
-            q.conditions = parse_conditions(m.group(1))
-    elif m := re.match(r"MODIFY FILTER \((.+)\) WITH \((.+)\)", query, re.I):
-        q.action = QueryAction.UPDATE
-        q.conditions = parse_conditions(m.group(1))
-        q.data = {k: v[1:-1] if v.startswith("'") else v for k, v in re.findall(r"(\w+)=('[^']*'|[0-9.]+)", m.group(2))}
-    elif m := re.match(r"REMOVE FILTER \((.+)\)", query, re.I):
-        q.action = QueryAction.DELETE
+def parse_values(text: str) -> Data:
+    return {k: v[1:-1] if v.startswith("'") else v for k, v in _KV_RE.findall(text)}
+
+def _parse_add(q: Query, m: re.Match):
+    q.action = QueryAction.INSERT
+    q.data = parse_values(m.group(1))
+
+def _parse_fetch(q: Query, m: re.Match):
+    q.action = QueryAction.SELECT
+    if m.group(1):
+        q.filter = parse_filter(m.group(1))
         q.conditions = parse_conditions(m.group(1))
-    elif m := re.match(r"INDEX FIELD ([\w,]+)", query, re.I):
-        q.action = QueryAction.INDEX
-        q.index_field = m.group(1)  # Support comma-separated fields
-    elif m := re.match(r"TRANSACT OPS \((.+)\)", query, re.I):
-        q.action = QueryAction.TRANSACT
-        ops_str = m.group(1)
-        for op in re.finditer(r"(?:ADD DATA \((.+?)\)|MODIFY FILTER \((.+?)\) WITH \((.+?)\)|REMOVE FILTER \((.+?)\))(?:;|$)", ops_str):
-            if op.group(1):
-                q.transact_ops.append(("INSERT", {}, {k: v[1:-1] if v.startswith("'") else v for k, v in re.findall(r"(\w+)=('[^']*'|[0-9.]+)", op.group(1))}))
-            elif op.group(2) and op.group(3):
-                q.transact_ops.append(("UPDATE", parse_conditions(op.group(2)), {k: v[1:-1] if v.startswith("'") else v for k, v in re.findall(r"(\w+)=('[^']*'|[0-9.]+)", op.group(3))}))
-            elif op.group(4):
-                q.transact_ops.append(("DELETE", parse_conditions(op.group(4)), {}))
-    elif m := re.match(r"AGGREGATE \((.+)\)(?: FILTER \((.+)\))?(?: GROUP BY (\w+))?(?: SORT BY (\w+):(\w+))?", query, re.I):
-        q.action = QueryAction.AGGREGATE
-        q.aggregate = {k: v for k, v in re.findall(r"(\w+)=([$]\w+)", m.group(1))}
-        if m.group(2):
-            q.conditions = parse_conditions(m.group(2))
-        if m.group(3):
-            q.group_by = m.group(3)
-        if m.group(4) and m.group(5):
-            q.sort = {m.group(4): m.group(5).lower()}
-    elif m := re.match(r"JOIN (\w+) ON (\w+)=(\w+)(?: FILTER \((.+)\))?", query, re.I):
-        q.action = QueryAction.JOIN
-        q.join = {"collection": m.group(1), "on": f"{m.group(2)}={m.group(3)}"}
-        if m.group(4):
-            q.conditions = parse_conditions(m.group(4))
-    else:
+
+def _parse_modify(q: Query, m: re.Match):
+    q.action = QueryAction.UPDATE
+    q.conditions = parse_conditions(m.group(1))
+    q.data = parse_values(m.group(2))
+
+def _parse_remove(q: Query, m: re.Match):
+    q.action = QueryAction.DELETE
+    q.conditions = parse_conditions(m.group(1))
+
+def _parse_index(q: Query, m: re.Match):
+    q.action = QueryAction.INDEX
+    q.index_field = m.group(1)  # Support comma-separated fields
+
+def _parse_transact(q: Query, m: re.Match):
+    q.action = QueryAction.TRANSACT
+    q.transact_ops = [parse_transact_op(op) for op in split_ops(m.group(1))]
+
+def _parse_aggregate(q: Query, m: re.Match):
+    q.action = QueryAction.AGGREGATE
+    q.aggregate = {k: v for k, v in _AGG_FIELD_RE.findall(m.group(1))}
+    if m.group(2):
+        q.conditions = parse_conditions(m.group(2))
+    if m.group(3):
+        q.group_by = m.group(3)
+    if m.group(4) and m.group(5):
+        q.sort = {m.group(4): m.group(5).lower()}
+
+def _parse_join(q: Query, m: re.Match):
+    q.action = QueryAction.JOIN
+    q.join = {"collection": m.group(1), "on": f"{m.group(2)}={m.group(3)}"}
+    if m.group(4):
+        q.conditions = parse_conditions(m.group(4))
+
+# The leading keyword picks the one statement pattern worth trying
+_DISPATCH = {
+    "ADD": (_ADD_RE, _parse_add),
+    "FETCH": (_FETCH_RE, _parse_fetch),
+    "MODIFY": (_MODIFY_RE, _parse_modify),
+    "REMOVE": (_REMOVE_RE, _parse_remove),
+    "INDEX": (_INDEX_RE, _parse_index),
+    "TRANSACT": (_TRANSACT_RE, _parse_transact),
+    "AGGREGATE": (_AGGREGATE_RE, _parse_aggregate),
+    "JOIN": (_JOIN_RE, _parse_join),
+}
+
+def parse_my_query(query: str) -> Query:
+    q = Query()
+    keyword = query.split(" ", 1)[0].upper()
+    statement = _DISPATCH.get(keyword)
+    m = statement[0].match(query) if statement else None
+    if not m:
         raise ValueError("Invalid query")
+    statement[1](q, m)
     return q
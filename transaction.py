@@ -1,11 +1,13 @@
-from typing import Dict
+from typing import Dict, Optional
 from database import Collection
+from index import IndexManager
+from mydb_types import Record
 
 class Transaction:
     def __init__(self, collection: Collection):
         self.collection = collection
-        self.original_data = collection.data.copy()
-        self.original_indexes = collection.indexes.copy()
+        # Filled in by the writes during commit, so only the touched records are kept
+        self.undo: Dict[str, Optional[Record]] = {}
         self.operations = []
 
     def insert(self, record: Dict):
@@ -18,20 +20,43 @@ class Transaction:
         self.operations.append(("delete", condition))
 
     def commit(self):
-        try:
-            for op in self.operations:
-                op_type = op[0]
-                if op_type == "insert":
-                    self.collection.insert(op[1])
-                elif op_type == "update":
-                    self.collection.update(op[1], op[2])
-                elif op_type == "delete":
-                    self.collection.delete(op[1])
-            self.collection.db.debounce_save()
-        except Exception as e:
-            self.rollback()
-            raise e
+        collection = self.collection
+        with collection.lock:
+            collection._undo = self.undo
+            try:
+                rewrite = False
+                for op in self.operations:
+                    op_type = op[0]
+                    if op_type == "insert":
+                        collection._insert(op[1])
+                    elif op_type == "update":
+                        rewrite = collection._update(op[1], op[2]) > 0 or rewrite
+                    elif op_type == "delete":
+                        rewrite = collection._delete(op[1]) > 0 or rewrite
+            except Exception as e:
+                self.rollback()
+                raise e
+            finally:
+                collection._undo = None
+            # Group commit: bump the version and save once for all operations
+            collection._after_write(rewrite)
 
     def rollback(self):
-        self.collection.data = self.original_data.copy()
-        self.collection.indexes = self.original_indexes.copy()
+        collection = self.collection
+        # Only called from commit, while the collection's write lock is held
+        assert collection.lock._writer, "rollback needs the collection's write lock"
+        collection._flush_pending()
+        collection._wal_ops.clear()
+        index_fields = [tuple(index_key.split(",")) for index_key in collection.indexes]
+        for key, record in self.undo.items():
+            current = collection.data.pop(key, None) if record is None else collection.data.get(key)
+            for fields in index_fields:
+                if current is not None:
+                    IndexManager.remove_record(fields, current, key, collection.indexes)
+                if record is not None:
+                    IndexManager.add_record(fields, record, key, collection.indexes)
+            if record is not None:
+                collection.data[key] = record
+        self.undo.clear()
+        collection.version += 1
+        collection.rewrite_version = collection.version